@@ -286,7 +286,11 @@ def WriteGenericNinja(path, static_libraries, executables,
     'ld = ' + ld,
     '',
     'rule regen',
-    '  command = %s ../build/gen.py%s' % (sys.executable, args),
+    '  command = %s %s%s' % (
+        sys.executable,
+        os.path.relpath(os.path.join(SCRIPT_DIR, 'gen.py'),
+                        os.path.dirname(path)),
+        args),
     '  description = Regenerating ninja files',
     '',
     'build build.ninja: regen',
@@ -376,6 +380,21 @@ def WriteGenericNinja(path, static_libraries, executables,
           [library_to_a(library) for library in settings['libs']]),
     ])
 
+  # run_tests always reruns since it never produces an output. It is left
+  # out of the default targets so a plain `ninja` invocation only builds.
+  ninja_lines.extend([
+    '',
+    'rule run_test',
+    '  command = %s' % ('$in' if platform.is_windows() else './$in'),
+    '  description = TEST $in',
+    '  pool = console',
+    '',
+    'build run_tests: run_test gn_unittests%s' % executable_ext,
+    '',
+    'default %s' % ' '.join(
+        executable + executable_ext for executable in executables),
+  ])
+
   ninja_lines.append('')  # Make sure the file ends with a newline.
 
   with open(path, 'w') as f:
@@ -65,15 +65,22 @@ class MacOSSDKApi(recipe_api.RecipeApi):
       yield
       return
 
+    selected = False
     try:
       with self.m.context(infra_steps=True):
-        self._sdk_dir = self._ensure_sdk()
+        # The SDK only needs to be deployed the first time the context is
+        # entered.
+        if not self._sdk_dir:
+          self._sdk_dir = self._ensure_sdk()
         self.m.step('select XCode',
                     ['sudo', 'xcode-select', '--switch', self._sdk_dir])
+        selected = True
       yield
     finally:
-      with self.m.context(infra_steps=True):
-        self.m.step('reset XCode', ['sudo', 'xcode-select', '--reset'])
+      # Nothing to reset if deploying the SDK failed before the switch.
+      if selected:
+        with self.m.context(infra_steps=True):
+          self.m.step('reset XCode', ['sudo', 'xcode-select', '--reset'])
 
   def _ensure_sdk(self):
     """Ensures the mac_toolchain tool and MacOS SDK packages are installed.
@@ -85,6 +92,16 @@ class MacOSSDKApi(recipe_api.RecipeApi):
     self.m.cipd.ensure(cache_dir, pkgs)
 
     sdk_dir = cache_dir.join('XCode.app')
+
+    # mac_toolchain is a no-op when the requested XCode is already installed,
+    # but starting it still costs a step, so remember successful installs in
+    # the cache. Stamps of other versions are dropped before installing since
+    # they all share `sdk_dir`.
+    stamp = cache_dir.join('.installed-%s' % self._sdk_version)
+    if self.m.path.exists(stamp):
+      return sdk_dir
+
+    self.m.file.rmglob('remove xcode stamps', cache_dir, '.installed-*')
     self.m.step('install xcode', [
         cache_dir.join('mac_toolchain'),
         'install',
@@ -95,4 +112,5 @@ class MacOSSDKApi(recipe_api.RecipeApi):
         '-output-dir',
         sdk_dir,
     ])
+    self.m.file.write_text('stamp xcode', stamp, self._sdk_version)
     return sdk_dir
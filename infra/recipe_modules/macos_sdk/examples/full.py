@@ -4,6 +4,7 @@
 
 DEPS = [
     'macos_sdk',
+    'recipe_engine/path',
     'recipe_engine/platform',
     'recipe_engine/properties',
     'recipe_engine/step',
@@ -16,8 +17,16 @@ def RunSteps(api):
     api.step('gn', ['gn', 'gen', 'out/Release'])
     api.step('ninja', ['ninja', '-C', 'out/Release'])
 
+  # Entering the context again reuses the SDK deployed above.
+  with api.macos_sdk():
+    api.step('gn check', ['gn', 'check', 'out/Release'])
+
 
 def GenTests(api):
   for platform in ('linux', 'mac', 'win'):
     yield (api.test(platform) + api.platform.name(platform) +
            api.properties.generic(buildername='test_builder'))
+
+  yield (api.test('mac_installed') + api.platform.name('mac') +
+         api.properties.generic(buildername='test_builder') + api.path.exists(
+             api.path['cache'].join('macos_sdk', '.installed-12b5025f')))
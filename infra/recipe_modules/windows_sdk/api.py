@@ -13,6 +13,7 @@ class WindowsSDKApi(recipe_api.RecipeApi):
   def __init__(self, sdk_properties, *args, **kwargs):
     super(WindowsSDKApi, self).__init__(*args, **kwargs)
 
+    self._sdk_env_kwargs = None
     self._sdk_package = sdk_properties['sdk_package']
     self._sdk_version = sdk_properties['sdk_version']
 
@@ -29,10 +30,14 @@ class WindowsSDKApi(recipe_api.RecipeApi):
       yield
       return
 
-    with self.m.context(infra_steps=True):
-      sdk_dir = self._ensure_sdk()
+    # The SDK only needs to be deployed, and its environment read, the first
+    # time the context is entered.
+    if not self._sdk_env_kwargs:
+      with self.m.context(infra_steps=True):
+        sdk_dir = self._ensure_sdk()
+      self._sdk_env_kwargs = self._sdk_env(sdk_dir)
 
-    with self.m.context(**self._sdk_env(sdk_dir)):
+    with self.m.context(**self._sdk_env_kwargs):
       try:
         yield
       finally:
@@ -15,6 +15,10 @@ def RunSteps(api):
     api.step('gn', ['gn', 'gen', 'out/Release'])
     api.step('ninja', ['ninja', '-C', 'out/Release'])
 
+  # Entering the context again reuses the SDK set up above.
+  with api.windows_sdk():
+    api.step('gn check', ['gn', 'check', 'out/Release'])
+
 
 def GenTests(api):
   for platform in ('linux', 'mac', 'win'):
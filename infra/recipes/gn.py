@@ -3,6 +3,10 @@
 # that can be found in the LICENSE file.
 """Recipe for building GN."""
 
+import hashlib
+
+from collections import namedtuple
+
 from recipe_engine.recipe_api import Property
 
 DEPS = [
@@ -11,6 +15,7 @@ DEPS = [
     'recipe_engine/cipd',
     'recipe_engine/context',
     'recipe_engine/file',
+    'recipe_engine/futures',
     'recipe_engine/json',
     'recipe_engine/path',
     'recipe_engine/platform',
@@ -30,6 +35,38 @@ PROPERTIES = {
 JEMALLOC_GIT_URL = 'https://fuchsia.googlesource.com/third_party/github.com/jemalloc/jemalloc.git'
 JEMALLOC_TAG = '5.3.0'
 
+# Tag that build/gen.py counts commits from to compute the commit position.
+ROOT_TAG = 'initial-commit'
+
+# A build configuration: the gen.py arguments it passes, the targets it builds
+# for, and whether those targets link against jemalloc.
+Config = namedtuple('Config', 'name args targets use_jemalloc')
+
+# Platforms the release config builds for, by host platform. Other hosts only
+# build for themselves.
+_RELEASE_PLATFORMS = {
+    'linux': ('linux-amd64', 'linux-arm64', 'linux-riscv64'),
+    'mac': ('mac-amd64', 'mac-arm64'),
+}
+
+# CIPD packages needed to build GN, as (name, version, subdir) tuples.
+_BASE_PACKAGES = (('infra/ninja/${platform}', 'version:1.8.2', ''),)
+_CLANG_PACKAGE = ('fuchsia/third_party/clang/${platform}', 'integration', '')
+_PLATFORM_PACKAGES = {
+    'linux': (
+        _CLANG_PACKAGE,
+        ('fuchsia/third_party/sysroot/linux',
+         'git_revision:c912d089c3d46d8982fdef76a50514cca79b6132', 'sysroot'),
+        # RISCV64 support starts in focal.
+        ('fuchsia/third_party/sysroot/focal',
+         'git_revision:fa7a5a9710540f30ff98ae48b62f2cdf72ed2acd',
+         'sysroot-focal'),
+    ),
+    'mac': (_CLANG_PACKAGE,),
+    'win': (),
+}
+
+
 def _get_libcxx_include_path(api):
   # Run the preprocessor with an empty input and print all include paths.
   lines = api.step(
@@ -50,6 +87,10 @@ def _get_libcxx_include_path(api):
   return None  # pragma: no cover
 
 
+def _cipd_stamp(packages):
+  return hashlib.sha256(repr(sorted(packages)).encode()).hexdigest()
+
+
 def _get_compilation_environment(api, target, cipd_dir):
   if target.is_linux:
     triple = '--target=%s' % target.triple
@@ -95,81 +136,164 @@ def _get_compilation_environment(api, target, cipd_dir):
   return env
 
 
-def RunSteps(api, repository):
-  src_dir = api.path['start_dir'].join('gn')
+def _checkout(api, repository, src_dir):
+  """Checks out the revision (and patchsets) being built into `src_dir`.
+
+  Returns the revision of the base commit.
+  """
+  build_input = api.buildbucket.build_input
+  # The revision is the exact commit fetched below, so there's no need to ask
+  # git for HEAD once it is checked out.
+  revision = build_input.gitiles_commit.id
+  if not revision:
+    # Resolve the branch up front so the fetch below asks for an exact commit,
+    # and the build can't race with the branch moving.
+    ref = build_input.gitiles_commit.ref or 'refs/heads/main'
+    with api.context(infra_steps=True):
+      refs = api.step(
+          'ls-remote', ['git', 'ls-remote', repository, ref],
+          stdout=api.raw_io.output_text(),
+          step_test_data=lambda: api.raw_io.test_api.stream_output_text(
+              '%s\t%s\n' % ('b' * 40, ref))).stdout.split()
+    if not refs:
+      raise api.step.InfraFailure('%s not found in %s' % (ref, repository))
+    revision = refs[0]
 
-  # TODO: Verify that building and linking jemalloc works on OS X and Windows as
-  # well.
   with api.step.nest('git'), api.context(infra_steps=True):
-    api.step('init', ['git', 'init', src_dir])
-
-    with api.context(cwd=src_dir):
-      build_input = api.buildbucket.build_input
-      ref = (
-          build_input.gitiles_commit.id
-          if build_input.gitiles_commit else 'refs/heads/master')
-      # Fetch tags so `git describe` works.
-      api.step('fetch', ['git', 'fetch', '--tags', repository, ref])
-      api.step('checkout', ['git', 'checkout', 'FETCH_HEAD'])
-      revision = api.step(
-          'rev-parse', ['git', 'rev-parse', 'HEAD'],
-          stdout=api.raw_io.output_text()).stdout.strip()
-      for change in build_input.gerrit_changes:
+    _fetch_revision(api, repository, src_dir, revision)
+    try:
+      _reset_checkout(api, src_dir)
+    except api.step.StepFailure:
+      # A build killed in the middle of a git operation can leave the cached
+      # checkout's local state broken (e.g. with a stale index.lock), which
+      # would then fail every later build on the bot. Start over from a fresh
+      # clone. Failed fetches aren't handled here: they are either transient
+      # or a bad ref, and throwing the cache away wouldn't fix either.
+      api.file.rmtree('remove checkout', src_dir)
+      _fetch_revision(api, repository, src_dir, revision)
+      _reset_checkout(api, src_dir)
+
+    if build_input.gerrit_changes:
+      # Checking out each patchset in turn would leave the last one checked
+      # out, so that is the only one worth fetching.
+      change = build_input.gerrit_changes[-1]
+      with api.context(cwd=src_dir):
         api.step('fetch %s/%s' % (change.change, change.patchset), [
-            'git', 'fetch', repository,
+            'git', 'fetch', '--no-tags', 'origin',
             'refs/changes/%s/%s/%s' %
             (str(change.change)[-2:], change.change, change.patchset)
         ])
         api.step('checkout %s/%s' % (change.change, change.patchset),
                  ['git', 'checkout', 'FETCH_HEAD'])
 
+  return revision
+
+
+def _fetch_revision(api, repository, src_dir, revision):
+  """Fetches `revision` into `src_dir`, cloning it first if needed."""
+  if not api.path.exists(src_dir.join('.git')):
+    # One clone sets up origin, brings in the history and the tags, and
+    # either succeeds or leaves nothing behind for the next build to trip
+    # over (unlike an interrupted init + remote add + fetch).
+    #
+    # `git describe` only walks commits, but checking out a patchset later
+    # needs its trees, so make this a blobless (rather than treeless)
+    # partial clone. Later fetches from origin are filtered the same way.
+    api.step('clone', [
+        'git', 'clone', '--filter=blob:none', '--no-checkout',
+        '--single-branch', '--branch', 'main', repository, src_dir
+    ])
+
+  # The fetch can't be shallow: gen.py computes the commit position by
+  # running `git describe` against the root tag, which walks the whole
+  # history. That tag is the only one needed, so skip all the others.
+  with api.context(cwd=src_dir):
+    api.step('fetch', [
+        'git', 'fetch', '--no-tags', '--filter=blob:none', 'origin', revision,
+        'refs/tags/%s:refs/tags/%s' % (ROOT_TAG, ROOT_TAG)
+    ])
+
+
+def _reset_checkout(api, src_dir):
+  """Checks out the fetched revision in `src_dir`."""
+  # Throw away whatever the previous build left in the cache, including its
+  # out directories.
+  with api.context(cwd=src_dir):
+    api.step('reset', ['git', 'reset', '--hard', 'FETCH_HEAD'])
+    api.step('clean', ['git', 'clean', '-ffdx'])
+
+
+def _ensure_tools(api, cipd_dir):
+  """Installs the CIPD packages needed to build GN into `cipd_dir`."""
   with api.context(infra_steps=True):
-    cipd_dir = api.path['start_dir'].join('cipd')
-    pkgs = api.cipd.EnsureFile()
-    pkgs.add_package('infra/ninja/${platform}', 'version:1.8.2')
-    if api.platform.is_linux or api.platform.is_mac:
-      pkgs.add_package('fuchsia/third_party/clang/${platform}', 'integration')
-    if api.platform.is_linux:
-      pkgs.add_package('fuchsia/third_party/sysroot/linux',
-                       'git_revision:c912d089c3d46d8982fdef76a50514cca79b6132',
-                       'sysroot')
-      # RISCV64 support starts in focal.
-      pkgs.add_package('fuchsia/third_party/sysroot/focal',
-                       'git_revision:fa7a5a9710540f30ff98ae48b62f2cdf72ed2acd',
-                       'sysroot-focal')
-    api.cipd.ensure(cipd_dir, pkgs)
-
-  def release_targets():
-    if api.platform.is_linux:
-      return [
-          api.target('linux-amd64'),
-          api.target('linux-arm64'),
-          api.target('linux-riscv64')
-      ]
-    elif api.platform.is_mac:
-      return [api.target('mac-amd64'), api.target('mac-arm64')]
-    else:
-      return [api.target.host]
+    # `cipd ensure` is skipped when the cache already holds exactly the
+    # requested packages, which is only knowable when every version is pinned
+    # to a tag: refs such as `integration` can move without the package list
+    # changing.
+    packages = _BASE_PACKAGES + _PLATFORM_PACKAGES[api.platform.name]
+    pinned = all(':' in version for _, version, _ in packages)
+    stamp = _cipd_stamp(packages)
+    stamp_file = cipd_dir.join('.stamp')
+    if not (pinned and api.path.exists(stamp_file) and
+            api.file.read_text('read cipd stamp', stamp_file) == stamp):
+      pkgs = api.cipd.EnsureFile()
+      for name, version, subdir in packages:
+        pkgs.add_package(name, version, subdir)
+      api.cipd.ensure(cipd_dir, pkgs)
+      if pinned:
+        api.file.write_text('write cipd stamp', stamp_file, stamp)
+
+
+def RunSteps(api, repository):
+  # The checkout lives in the "gn" named cache, so on a warm bot only the
+  # commits added since the previous build have to be fetched. The tools
+  # live in the "gn_tools" named cache.
+  src_dir = api.path['cache'].join('gn')
+  cipd_dir = api.path['cache'].join('gn_tools')
+  build_input = api.buildbucket.build_input
+
+  # Fetching the source and installing the tools don't depend on each other,
+  # so overlap them.
+  checkout = api.futures.spawn(_checkout, api, repository, src_dir)
+  tools = api.futures.spawn(_ensure_tools, api, cipd_dir)
+  api.futures.wait([checkout, tools])
+  revision = checkout.result()
+  tools.result()
+
+  # TODO: Verify that building and linking jemalloc works on OS X and Windows as
+  # well.
+
+  release_platforms = _RELEASE_PLATFORMS.get(api.platform.name)
+  if release_platforms:
+    release_targets = [api.target(p) for p in release_platforms]
+  else:
+    release_targets = [api.target.host]
 
-  # The order is important since release build will get uploaded to CIPD.
   configs = [
-      {
-          'name': 'debug',
-          'args': ['-d'],
-          'targets': [api.target.host],
-      },
-      {
-          'name': 'release',
-          'args': ['--use-lto', '--use-icf'],
-          'targets': release_targets(),
+      Config(
+          name='debug',
+          args=['-d'],
+          targets=[api.target.host],
+          use_jemalloc=False),
+      Config(
+          name='release',
+          args=['--use-lto', '--use-icf'],
+          targets=release_targets,
           # TODO: Enable this for OS X and Windows.
-          'use_jemalloc': api.platform.is_linux,
-      },
+          use_jemalloc=api.platform.is_linux),
   ]
 
-  use_jemalloc = any(c.get('use_jemalloc', False) for c in configs)
+  use_jemalloc = any(c.use_jemalloc for c in configs)
 
   with api.macos_sdk(), api.windows_sdk():
+    # Targets of the same platform build with the same environment, so only
+    # compute it once per platform rather than once per config.
+    envs = {}
+    for c in configs:
+      for t in c.targets:
+        if t.platform not in envs:
+          envs[t.platform] = _get_compilation_environment(api, t, cipd_dir)
+
     # Build the jemalloc static library if needed.
     if use_jemalloc:
       # Maps a target.platform string to the location of the corresponding
@@ -182,13 +306,13 @@ def RunSteps(api, repository):
       #
       # For each platform, a version of jemalloc will be built if necessary,
       # but doing this properly requires having a valid target instance to
-      # call _get_compilation_environment. So create a { platform -> Target }
-      # map to do that later.
+      # get the target triple from. So create a { platform -> Target } map to
+      # do that later.
       all_config_platforms = {}
       for c in configs:
-        if not c.get('use_jemalloc', False):
+        if not c.use_jemalloc:
           continue
-        for t in c['targets']:
+        for t in c.targets:
           if t.platform not in all_config_platforms:
             all_config_platforms[t.platform] = t
 
@@ -208,7 +332,7 @@ def RunSteps(api, repository):
 
           target = all_config_platforms[platform]
           host_target = api.target.host
-          env = _get_compilation_environment(api, target, cipd_dir)
+          env = dict(envs[platform])
 
           # Prepare environment for configuring and building jemalloc
           #
@@ -246,73 +370,100 @@ def RunSteps(api, repository):
 
           jemalloc_static_libs[platform]  = jemalloc_static_lib
 
-    for config in configs:
-      with api.step.nest(config['name']):
-        for target in config['targets']:
-          env = _get_compilation_environment(api, target, cipd_dir)
-          with api.step.nest(target.platform), api.context(
-              env=env, cwd=src_dir):
-            args = config['args']
-            if config.get('use_jemalloc', False):
-              args = args[:] + [
-                  '--link-lib=%s' % jemalloc_static_libs[target.platform]
-              ]
-
-            api.step('generate',
-                     ['python3', '-u', src_dir.join('build', 'gen.py')] + args)
-
-            # Windows requires the environment modifications when building too.
-            api.step('build',
-                     [cipd_dir.join('ninja'), '-C',
-                      src_dir.join('out')])
-
-            if target.is_host:
-              api.step('test', [src_dir.join('out', 'gn_unittests')])
-
-            if config['name'] != 'release':
-              continue
-
-            with api.step.nest('upload'):
-              gn = 'gn' + ('.exe' if target.is_win else '')
-
-              if build_input.gerrit_changes:
-                # Upload to CAS from CQ.
-                api.cas.archive('upload binary to CAS', src_dir.join('out'),
-                                src_dir.join('out', gn))
-                continue
-
-              cipd_pkg_name = 'gn/gn/%s' % target.platform
-
-              pkg_def = api.cipd.PackageDefinition(
-                  package_name=cipd_pkg_name,
-                  package_root=src_dir.join('out'),
-                  install_mode='copy')
-              pkg_def.add_file(src_dir.join('out', gn))
-              pkg_def.add_version_file('.versions/%s.cipd_version' % gn)
-
-              cipd_pkg_file = api.path['cleanup'].join('gn.cipd')
-
-              api.cipd.build_from_pkg(
-                  pkg_def=pkg_def,
-                  output_package=cipd_pkg_file,
-              )
-
-              if api.buildbucket.builder_id.project == 'infra-internal':
-                cipd_pin = api.cipd.search(cipd_pkg_name,
-                                           'git_revision:' + revision)
-                if cipd_pin:
-                  api.step('Package is up-to-date', cmd=None)
-                  continue
-
-                api.cipd.register(
-                    package_name=cipd_pkg_name,
-                    package_path=cipd_pkg_file,
-                    refs=['latest'],
-                    tags={
-                        'git_repository': repository,
-                        'git_revision': revision,
-                    },
-                )
+    def build(config, target):
+      out_dir = src_dir.join('out', config.name)
+      with api.step.nest(target.platform), api.context(
+          env=envs[target.platform], cwd=src_dir):
+        args = config.args
+        if config.use_jemalloc:
+          args = args[:] + [
+              '--link-lib=%s' % jemalloc_static_libs[target.platform]
+          ]
+
+        api.step('generate', [
+            'python3', '-u',
+            src_dir.join('build', 'gen.py'),
+            '--out-path=%s' % out_dir
+        ] + args)
+
+        # Windows requires the environment modifications when building too.
+        #
+        # Both configs build at the same time, so also have each ninja hold
+        # back new jobs while the bot is loaded.
+        api.step('build', [
+            cipd_dir.join('ninja'), '-C', out_dir,
+            '-j', str(api.platform.cpu_count + 2),
+            '-l', str(api.platform.cpu_count)
+        ])
+
+        # Run the tests through the run_tests edge in build.ninja.
+        if target.is_host:
+          api.step('test', [cipd_dir.join('ninja'), '-C', out_dir,
+                            'run_tests'])
+
+        if config.name != 'release':
+          return
+
+        # Only infra-internal builders publish to CIPD, so CI builds elsewhere
+        # have nothing to upload and shouldn't bother packaging the binary.
+        if (not build_input.gerrit_changes and
+            api.buildbucket.builder_id.project != 'infra-internal'):
+          return
+
+        with api.step.nest('upload'):
+          gn = 'gn' + ('.exe' if target.is_win else '')
+
+          if build_input.gerrit_changes:
+            # Upload to CAS from CQ.
+            api.cas.archive('upload binary to CAS', out_dir,
+                            out_dir.join(gn))
+            return
+
+          cipd_pkg_name = 'gn/gn/%s' % target.platform
+
+          cipd_pin = api.cipd.search(cipd_pkg_name, 'git_revision:' + revision)
+          if cipd_pin:
+            api.step('Package is up-to-date', cmd=None)
+            return
+
+          pkg_def = api.cipd.PackageDefinition(
+              package_name=cipd_pkg_name,
+              package_root=out_dir,
+              install_mode='copy')
+          pkg_def.add_file(out_dir.join(gn))
+          pkg_def.add_version_file('.versions/%s.cipd_version' % gn)
+
+          cipd_pkg_file = api.path['cleanup'].join('gn.cipd')
+
+          api.cipd.build_from_pkg(
+              pkg_def=pkg_def,
+              output_package=cipd_pkg_file,
+          )
+
+          api.cipd.register(
+              package_name=cipd_pkg_name,
+              package_path=cipd_pkg_file,
+              refs=['latest'],
+              tags={
+                  'git_repository': repository,
+                  'git_revision': revision,
+              },
+          )
+
+    def build_config(config):
+      with api.step.nest(config.name):
+        # The targets of a config share its out directory, and building them
+        # all at once (up to three LTO links on linux) would overload the bot
+        # anyway, so build them one after the other.
+        for target in config.targets:
+          build(config, target)
+
+    # Each config builds into its own out directory and shares no state with
+    # the others, so build them concurrently.
+    futures = [api.futures.spawn(build_config, config) for config in configs]
+    api.futures.wait(futures)
+    for future in futures:
+      future.result()
 
 
 def GenTests(api):
@@ -333,8 +484,6 @@ def GenTests(api):
       project='infra-internal',
       git_repo='gn.googlesource.com/gn',
       revision='a' * 40,
-  ) + api.step_data(
-      'git.rev-parse', api.raw_io.stream_output_text('a' * 40)
   ) + api.step_data(
       'release.linux-amd64.upload.cipd search gn/gn/linux-amd64 git_revision:' +
       'a' * 40,
@@ -345,8 +494,38 @@ def GenTests(api):
       project='infra-internal',
       git_repo='gn.googlesource.com/gn',
       revision='a' * 40,
-  ) + api.step_data(
-      'git.rev-parse', api.raw_io.stream_output_text('a' * 40)
   ) + api.step_data(
       'release.linux-amd64.upload.cipd search gn/gn/linux-amd64 git_revision:' +
       'a' * 40, api.cipd.example_search('gn/gn/linux-amd64', [])))
+
+  yield (api.test('ci_cached_checkout') + api.buildbucket.ci_build(
+      project='gn',
+      git_repo='gn.googlesource.com/gn',
+  ) + api.path.exists(api.path['cache'].join('gn', '.git')))
+
+  yield (api.test('ci_broken_checkout') + api.buildbucket.ci_build(
+      project='gn',
+      git_repo='gn.googlesource.com/gn',
+  ) + api.path.exists(api.path['cache'].join('gn', '.git')) +
+         api.step_data('git.reset', retcode=1))
+
+  yield (api.test('ci_fetch_failure') + api.buildbucket.ci_build(
+      project='gn',
+      git_repo='gn.googlesource.com/gn',
+  ) + api.path.exists(api.path['cache'].join('gn', '.git')) +
+         api.step_data('git.fetch', retcode=1))
+
+  yield (api.test('cq_missing_ref') + api.buildbucket.try_build(
+      project='gn',
+      git_repo='gn.googlesource.com/gn',
+  ) + api.step_data('ls-remote', api.raw_io.stream_output_text('')))
+
+  yield (api.test('ci_win_cached_tools') + api.platform.name('win') +
+         api.buildbucket.ci_build(
+             project='gn',
+             git_repo='gn.googlesource.com/gn',
+         ) + api.path.exists(api.path['cache'].join('gn_tools', '.stamp')) +
+         api.step_data('read cipd stamp',
+                       api.file.read_text(
+                           _cipd_stamp(_BASE_PACKAGES +
+                                       _PLATFORM_PACKAGES['win']))))